@@ -6,38 +6,57 @@ export SPOTIPY_CLIENT_ID='your-spotify-client-id'
 export SPOTIPY_CLIENT_SECRET='your-spotify-client-secret'
 export SPOTIPY_REDIRECT_URI='your-app-redirect-url'  # e.g. http://localhost
 export SPOTIPY_USERNAME='your-username'
+export SPOTIFY_POPULARITY_PLAYLIST_NO_CACHE=1  # optional, skips the album cache
 """
 import os
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain, islice
+from operator import itemgetter
 from pprint import pprint
-from typing import Generator, List, TypeVar
+from typing import Dict, Final, Iterable, Iterator, List, Optional, TypeVar, cast
 
-from fuzzywuzzy import fuzz, process  # type: ignore[import]
+import numpy as np
+from datasketch import MinHash, MinHashLSH  # type: ignore[import]
+from diskcache import Cache  # type: ignore[import]
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
 from spotipy import Spotify  # type: ignore[import]
 from spotipy.oauth2 import SpotifyClientCredentials  # type: ignore[import]
 from spotipy.oauth2 import SpotifyOAuth
 
 from spotify_popularity_playlist.spotify_types import (
     Album,
-    AlbumMatch,
     Artist,
     ArtistAlbums,
-    Scorer,
 )
 
 ARTIST = "artist"
 ARTISTS = f"{ARTIST}s"
-TRACKS = "tracks"
+TRACKS: Final = "tracks"
+ALBUMS = "albums"
+ARTIST_ALBUMS_PAGE_SIZE = 50
 ARTIST_CHUNK_SIZE = 20
 TRACK_CHUNK_SIZE = 50
 PLAYLIST_CHUNK_SIZE = 100
+MAX_WORKERS = 8
+LARGE_CATALOG_SIZE = 20000
+MINHASH_NUM_PERM = 64
+MINHASH_LSH_THRESHOLD = 0.9
 USERNAME = os.environ["SPOTIPY_USERNAME"]
 DEFAULT_SCOPE = Spotify(client_credentials_manager=(SpotifyClientCredentials()))
+CACHE_DIRECTORY = os.path.join(
+    os.path.expanduser("~"), ".cache", "spotify_popularity_playlist"
+)
+CACHE_EXPIRE_SECONDS = 7 * 24 * 60 * 60
+USE_CACHE = not os.environ.get("SPOTIFY_POPULARITY_PLAYLIST_NO_CACHE")
 
 
+@lru_cache(maxsize=None)
 def spotify_scope(scope_name: str) -> Spotify:
     """
-    Create a Spotify object with a particular scope.
+    Create a Spotify object with a particular scope. The object is cached per scope so
+    that creating several playlists in one session reuses the same authorization.
 
     :param scope_name: name of the scope
     :return: Spotify object at a specific scope
@@ -47,6 +66,58 @@ def spotify_scope(scope_name: str) -> Spotify:
     return scope
 
 
+@lru_cache(maxsize=None)
+def album_cache() -> Cache:
+    """
+    Open the on-disk album cache, only once it is first needed. Call this from the main
+    thread and hand the Cache to the workers, lru_cache doesn't stop concurrent first
+    calls from each opening their own Cache.
+
+    :return: Cache
+    """
+    return Cache(CACHE_DIRECTORY)
+
+
+def cached_albums(album_ids: List[str], cache: Optional[Cache]) -> List[Album]:
+    """
+    Return full Albums for album ids, served from the on-disk cache when possible.
+    Only albums are cached since their track listings rarely change, whereas the track
+    popularity we sort by does. Albums are cached by their own id, so a new album
+    shifting the chunk boundaries doesn't invalidate the rest. Any albums missing from
+    the cache are fetched together in a single request.
+
+    :param album_ids: List[str]
+    :param cache: Optional[Cache], None to bypass the cache
+    :return: List[Album]
+    """
+    if cache is None:
+        return fetch_albums(album_ids)
+    album_id_dict: Dict[str, Album] = {}
+    for album_id in album_ids:
+        cached_album: Optional[Album] = cache.get((ALBUMS, album_id))
+        if cached_album is not None:
+            album_id_dict[album_id] = cached_album
+    missing_album_ids = [
+        album_id for album_id in album_ids if album_id not in album_id_dict
+    ]
+    if missing_album_ids:
+        for album_id, album in zip(missing_album_ids, fetch_albums(missing_album_ids)):
+            cache.set((ALBUMS, album_id), album, expire=CACHE_EXPIRE_SECONDS)
+            album_id_dict[album_id] = album
+    return [album_id_dict[album_id] for album_id in album_ids]
+
+
+def fetch_albums(album_ids: List[str]) -> List[Album]:
+    """
+    Return full Albums for album ids from the spotify api.
+
+    :param album_ids: List[str]
+    :return: List[Album]
+    """
+    albums: List[Album] = DEFAULT_SCOPE.albums(album_ids)[ALBUMS]
+    return albums
+
+
 def artists_search(artist_name: str) -> List[Artist]:
     """
     Return a list of Artists from a spotify search.
@@ -60,95 +131,137 @@ def artists_search(artist_name: str) -> List[Artist]:
     return artists
 
 
-def simplified_artist_albums(
-    first_page_simplified_artist_albums: ArtistAlbums,
-) -> List[Album]:
+def simplified_artist_albums(artist_id: str) -> List[Album]:
     """
-    Gets all simplified artist albums via pagination.
+    Gets all simplified artist albums via pagination. The first page tells us the total
+    number of albums, so the remaining pages are requested concurrently by offset.
 
-    :param first_page_simplified_artist_albums: ArtistAlbums
+    :param artist_id: str
     :return: List[Album]
     """
-    cur_page_simplified_artist_albums = first_page_simplified_artist_albums
-    all_simplified_artist_albums = cur_page_simplified_artist_albums["items"]
-    while cur_page_simplified_artist_albums["next"] is not None:
-        cur_page_simplified_artist_albums = DEFAULT_SCOPE.next(
-            cur_page_simplified_artist_albums
-        )
-        all_simplified_artist_albums.extend(cur_page_simplified_artist_albums["items"])
+    first_page_simplified_artist_albums: ArtistAlbums = DEFAULT_SCOPE.artist_albums(
+        artist_id, limit=ARTIST_ALBUMS_PAGE_SIZE
+    )
+    all_simplified_artist_albums = first_page_simplified_artist_albums["items"]
+    page_size = first_page_simplified_artist_albums["limit"]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for cur_page_simplified_artist_albums in executor.map(
+            lambda offset: DEFAULT_SCOPE.artist_albums(
+                artist_id, limit=page_size, offset=offset
+            ),
+            range(page_size, first_page_simplified_artist_albums["total"], page_size),
+        ):
+            all_simplified_artist_albums.extend(
+                cur_page_simplified_artist_albums["items"]
+            )
     return all_simplified_artist_albums
 
 
 def deduplicate_by_name_and_add_popularity(
     albums: List[Album],
     threshold: int = 99,
-    scorer: Scorer = fuzz.token_set_ratio,
 ) -> List[Album]:
     """
-    Adapted from fuzzywuzzy dedupe function. Does string comparison on names but we
+    Adapted from the fuzzywuzzy dedupe function. Does string comparison on names but we
     index tracks by their unique id. Returns a list of albums sorted by popularity.
+    Names are compared as in fuzz.token_sort_ratio, which works well for song titles.
+
+    Albums are walked from most to least popular and each one is only admitted if no
+    already admitted album matches it, so the most popular duplicate always wins.
 
     :param albums: List[Album]
     :param threshold: int
-    :param scorer: Scorer, fuzz.token_set_ratio seems to work well for song titles.
     :return: List[Album]
     """
-    extractor_album_ids = []
-    album_id_dict = {album["id"]: album.copy() for album in albums}
-    dupe_album_id_names_dict = {album["id"]: album["name"] for album in albums}
-    for item in albums:
-        # return all duplicate album_matches found
-        album_matches = [
-            AlbumMatch(album_name=album_name, score=score, album_id=album_id)
-            for album_name, score, album_id in process.extract(
-                query=item["name"],
-                choices=dupe_album_id_names_dict,
-                limit=None,
-                scorer=scorer,
-            )
-        ]
-        # filter album_matches based on the threshold
-        filtered_album_matches = [
-            album_match
-            for album_match in album_matches
-            if album_match.score > threshold
-        ]
-        # if there is only 0 or 1 items in *filtered*, no duplicates were found so
-        # append to *extracted*. match[2] is an id.
-        if len(filtered_album_matches) == 1 or not [
-            i.album_id
-            for i in filtered_album_matches
-            if i.album_id in extractor_album_ids
-        ]:
-            extractor_album_ids.append(item["id"])
-
-    # check that extractor differs from contain_dupes (e.g. duplicates were found)
-    # if not, then return the original list
-    return (
-        sorted(
-            [album_id_dict[album_id] for album_id in extractor_album_ids],
-            key=lambda d: d["popularity"],
-            reverse=True,
+    admitted_albums: List[Album] = []
+    admitted_album_names: List[str] = []
+    # for large catalogs only compare against admitted names that share enough
+    # character shingles with the candidate to land in the same MinHash LSH bucket
+    admitted_album_names_lsh = (
+        MinHashLSH(threshold=MINHASH_LSH_THRESHOLD, num_perm=MINHASH_NUM_PERM)
+        if len(albums) > LARGE_CATALOG_SIZE
+        else None
+    )
+    # stable argsort on a packed array of the negated popularities gives a most to
+    # least popular order without a python key call per comparison
+    popularities = np.fromiter(
+        map(itemgetter("popularity"), albums), dtype=np.int16, count=len(albums)
+    )
+    for album in (albums[idx] for idx in np.argsort(-popularities, kind="stable")):
+        # normalize and sort the tokens of the name once, so that a plain fuzz.ratio
+        # gives the token_sort_ratio without redoing that work per comparison
+        album_name = sorted_token_name(album["name"])
+        # names that normalize to nothing, e.g. "?" or emoji only titles, can't be told
+        # apart and fuzz.ratio scores two empty strings as a match, so always admit them
+        if not album_name:
+            admitted_albums.append(album)
+            continue
+        if admitted_album_names_lsh is None:
+            candidate_album_names = admitted_album_names
+        else:
+            album_name_minhash = name_minhash(album_name)
+            candidate_album_names = [
+                admitted_album_names[admitted_idx]
+                for admitted_idx in admitted_album_names_lsh.query(album_name_minhash)
+            ]
+        album_match = process.extractOne(
+            album_name,
+            candidate_album_names,
+            scorer=fuzz.ratio,
+            processor=None,
+            score_cutoff=threshold,
         )
-        if len(extractor_album_ids) != len(albums)
-        else albums
+        if album_match is None or album_match[1] <= threshold:
+            if admitted_album_names_lsh is not None:
+                admitted_album_names_lsh.insert(
+                    len(admitted_album_names), album_name_minhash
+                )
+            admitted_albums.append(album)
+            admitted_album_names.append(album_name)
+    return admitted_albums
+
+
+def name_minhash(name: str) -> MinHash:
+    """
+    Create a MinHash over the character trigrams of a name. Trigrams rather than whole
+    tokens keep a small typo in one word from hiding an otherwise identical name.
+
+    :param name: str
+    :return: MinHash
+    """
+    minhash = MinHash(num_perm=MINHASH_NUM_PERM)
+    minhash.update_batch(
+        [name[idx : idx + 3].encode("utf-8") for idx in range(max(len(name) - 2, 1))]
     )
+    return minhash
+
+
+def sorted_token_name(name: str) -> str:
+    """
+    Normalize a name and sort its tokens, so that fuzz.ratio on two of these gives the
+    same score as fuzz.token_sort_ratio on the original names.
+
+    :param name: str
+    :return: str
+    """
+    return " ".join(sorted(cast(str, default_process(name)).split()))
 
 
 T = TypeVar("T")
 """Represents a homogenous member of a list"""
 
 
-def chunks(list_: List[T], chunk_size: int) -> Generator[List[T], None, None]:
+def chunks(list_: Iterable[T], chunk_size: int) -> Iterator[List[T]]:
     """
-    Yield successive n-sized chunks from list_.
+    Return an iterator of successive n-sized chunks from list_.
 
-    :param list_: List
+    :param list_: Iterable
     :param chunk_size: int
-    :return: Generator[List, None, None]
+    :return: Iterator[List]
     """
-    for idx in range(0, len(list_), chunk_size):
-        yield list_[idx : idx + chunk_size]
+    iterator = iter(list_)
+    # iter stops calling the lambda once it returns the empty list sentinel
+    return iter(lambda: list(islice(iterator, chunk_size)), [])
 
 
 def create_top_tracks_playlist(username: str, artist: Artist) -> None:
@@ -165,46 +278,51 @@ def create_top_tracks_playlist(username: str, artist: Artist) -> None:
     :param artist: Artist
     :return: None
     """
+    artist_id = artist["id"]
     artist_album_ids = [
-        artist_album["id"]
-        for artist_album in simplified_artist_albums(
-            DEFAULT_SCOPE.artist_albums(artist["id"], limit=50)
-        )
+        artist_album["id"] for artist_album in simplified_artist_albums(artist_id)
     ]
-    artist_albums = list(
-        chain(
-            *[
-                DEFAULT_SCOPE.albums(album_ids_chunk)["albums"]
-                for album_ids_chunk in chunks(artist_album_ids, ARTIST_CHUNK_SIZE)
-            ]
-        )
-    )
-    # Iterate through album tracks and only take ones matching that artist
-    artist_simplified_track_ids = [
-        track["id"]
-        for track in list(chain(*[album[TRACKS]["items"] for album in artist_albums]))
-        if artist["id"] in (track_artist["id"] for track_artist in track[ARTISTS])
-    ]
-
-    artist_tracks = list(
-        chain(
-            *[
-                DEFAULT_SCOPE.tracks(track_ids_chunk)[TRACKS]
-                for track_ids_chunk in chunks(
-                    artist_simplified_track_ids, TRACK_CHUNK_SIZE
+    # Open the album cache here, before any worker threads can race to open it
+    cache = album_cache() if USE_CACHE else None
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Overlap the album and track requests rather than waiting on each in turn
+        artist_albums = list(
+            chain.from_iterable(
+                executor.map(
+                    partial(cached_albums, cache=cache),
+                    chunks(artist_album_ids, ARTIST_CHUNK_SIZE),
                 )
-            ]
+            )
         )
-    )
+        # Iterate through album tracks and only take ones matching that artist
+        artist_simplified_track_ids = [
+            track["id"]
+            for track in chain.from_iterable(
+                album[TRACKS]["items"] for album in artist_albums
+            )
+            if any(track_artist["id"] == artist_id for track_artist in track[ARTISTS])
+        ]
+
+        # Extend a single list with each chunk of tracks as it comes back in order
+        artist_tracks: List[Album] = []
+        for tracks_response in executor.map(
+            DEFAULT_SCOPE.tracks, chunks(artist_simplified_track_ids, TRACK_CHUNK_SIZE)
+        ):
+            artist_tracks.extend(tracks_response[TRACKS])
     artist_tracks_by_popularity = deduplicate_by_name_and_add_popularity(
-        sorted(artist_tracks, key=lambda track: track["popularity"], reverse=True),
-        threshold=99,
-        scorer=fuzz.token_sort_ratio,
+        artist_tracks, threshold=99
     )
+    if not artist_tracks_by_popularity:
+        print(f"No tracks found for: {artist}")
+        return
     playlist_modify_public_scope = spotify_scope("playlist-modify-public")
     new_playlist = playlist_modify_public_scope.user_playlist_create(
         user=username, name=artist["name"] + " by Popularity"
     )
+    # These are added one chunk at a time on purpose: the playlist order is the
+    # popularity order, and concurrent adds would either land in completion order or,
+    # with explicit positions, fail when a later chunk's position is past the end of
+    # the playlist because an earlier chunk hasn't landed yet.
     for track_ids_chunk in chunks(
         [track["id"] for track in artist_tracks_by_popularity], PLAYLIST_CHUNK_SIZE
     ):
@@ -1,7 +1,6 @@
-from typing import List, NamedTuple, Optional
+from typing import Any, Dict, List, Optional
 
 from mypy_extensions import TypedDict
-from typing_extensions import Protocol
 
 
 class ExternalUrls(TypedDict):
@@ -40,6 +39,18 @@ class Artist(TypedDict):
     uri: str
 
 
+class AlbumTracks(TypedDict):
+    """Album Tracks dict, the tracks paging object in a full Album dict"""
+
+    href: str
+    items: List[Dict[str, Any]]
+    limit: int
+    next: Optional[str]
+    offset: int
+    previous: Optional[str]
+    total: int
+
+
 class Album(TypedDict, total=False):
     """Album dict, popularity in in a full Album dict"""
 
@@ -56,6 +67,7 @@ class Album(TypedDict, total=False):
     release_date: str
     release_date_precision: str
     total_tracks: int
+    tracks: AlbumTracks
     type: str
     uri: str
 
@@ -70,18 +82,3 @@ class ArtistAlbums(TypedDict):
     offset: int
     previous: str
     total: int
-
-
-class Scorer(Protocol):
-    def token_set_ratio(
-        self, s1: str, s2: str, force_ascii: bool = True, full_process: bool = True
-    ) -> int:
-        ...
-
-
-class AlbumMatch(NamedTuple):
-    """Represent album names matched by fuzzywuzzy"""
-
-    album_name: str
-    score: int
-    album_id: str